@@ -1,5 +1,4 @@
-#!/bin/sh
-""""exec python -B -- "$0" ${1+"$@"} # """
+#!/usr/bin/env python3
 # vi: syntax=python
 #
 # Copyright 2022 Telefonaktiebolaget LM Ericsson
@@ -16,40 +15,103 @@
 # limitations under the License.
 #
 
-from __future__ import print_function
-
 import os
 import signal
-import sys
-import glob
 import subprocess
-from argparse import ArgumentParser
-from io import open
+import sys
+import time
+from argparse import ArgumentParser, Namespace
 
-try:
-    from ecchronoslib import rest, table_printer
-except ImportError:
-    SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-    LIB_DIR = os.path.join(SCRIPT_DIR, "..", "pylib")
-    sys.path.append(LIB_DIR)
-    from ecchronoslib import rest, table_printer
+# Equivalent of running the interpreter with -B, set before ecchronoslib is imported
+sys.dont_write_bytecode = True
 
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+ECCHRONOS_HOME_DIR = os.path.dirname(SCRIPT_DIR)
 DEFAULT_PID_FILE = "ecc.pid"
+COMMAND_CACHE_FILE = ".ecc.cmdcache"
+STOP_TIMEOUT_SECONDS = 30
+RESTORED_SIGNALS = (signal.SIGPIPE, signal.SIGXFSZ)
 SPRINGBOOT_MAIN_CLASS = "com.ericsson.bss.cassandra.ecchronos.application.spring.SpringBooter"
-
-
-def parse_arguments():
-    parser = ArgumentParser(description="ecChronos utility command")
-    sub_parsers = parser.add_subparsers(dest="subcommand")
-    add_repairs_subcommand(sub_parsers)
-    add_schedules_subcommand(sub_parsers)
-    add_run_repair_subcommand(sub_parsers)
-    add_repair_info_subcommand(sub_parsers)
-    add_start_subcommand(sub_parsers)
-    add_stop_subcommand(sub_parsers)
-    add_status_subcommand(sub_parsers)
-
-    return parser.parse_args()
+STOP_PIDFILE_OPTIONS = ("-p", "--pidfile")
+STATUS_URL_OPTIONS = ("-u", "--url")
+# Options parsed without argparse by parse_simple_arguments, these must be the only options that
+# add_stop_subcommand and add_status_subcommand define
+SIMPLE_SUBCOMMAND_OPTIONS = {
+    "stop": dict.fromkeys(STOP_PIDFILE_OPTIONS, "pidfile"),
+    "status": dict.fromkeys(STATUS_URL_OPTIONS, "url"),
+}
+SIMPLE_DURATION_UNITS = ("", "NS", "US", "MS", "S", "M", "H", "D")
+MAX_DURATION_FRACTION_DIGITS = 9
+
+
+def _load_rest():
+    # Only the REST subcommands need ecchronoslib, start/stop should not pay for importing it
+    try:
+        from ecchronoslib import rest, table_printer # pylint: disable=import-outside-toplevel
+    except ImportError:
+        sys.path.append(os.path.join(ECCHRONOS_HOME_DIR, "pylib"))
+        from ecchronoslib import rest, table_printer # pylint: disable=import-outside-toplevel
+    return rest, table_printer
+
+
+class FastParser(ArgumentParser):
+    # add_argument() creates a new formatter for every argument only to validate the metavar,
+    # reuse a single formatter for that while help and usage output still get a fresh one
+    _adding_argument = False
+    _validation_formatter = None
+
+    def add_argument(self, *args, **kwargs):
+        self._adding_argument = True
+        try:
+            return ArgumentParser.add_argument(self, *args, **kwargs)
+        finally:
+            self._adding_argument = False
+
+    def _get_formatter(self):
+        if not self._adding_argument:
+            return ArgumentParser._get_formatter(self)
+        if self._validation_formatter is None:
+            self._validation_formatter = ArgumentParser._get_formatter(self)
+        return self._validation_formatter
+
+
+def parse_arguments(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    arguments = parse_simple_arguments(argv)
+    if arguments is not None:
+        return arguments
+    parser = FastParser(description="ecChronos utility command")
+    # Only build the parser for the requested subcommand, all of them are needed for top-level help and errors
+    if argv and argv[0] in SUBCOMMAND_PARSERS:
+        # The metavar keeps every subcommand in the usage line even though only one subparser is built
+        sub_parsers = parser.add_subparsers(dest="subcommand", parser_class=FastParser,
+                                            metavar="{" + ",".join(SUBCOMMAND_PARSERS) + "}")
+        SUBCOMMAND_PARSERS[argv[0]](sub_parsers)
+    else:
+        sub_parsers = parser.add_subparsers(dest="subcommand", parser_class=FastParser)
+        for add_subcommand in SUBCOMMAND_PARSERS.values():
+            add_subcommand(sub_parsers)
+
+    return parser.parse_args(argv)
+
+
+def parse_simple_arguments(argv):
+    # stop and status take at most one option so they are parsed without argparse,
+    # anything unexpected returns None and is left to argparse for help and error messages
+    if not argv or argv[0] not in SIMPLE_SUBCOMMAND_OPTIONS:
+        return None
+    options = SIMPLE_SUBCOMMAND_OPTIONS[argv[0]]
+    arguments = Namespace(subcommand=argv[0], **{dest: None for dest in options.values()})
+    option_args = argv[1:]
+    if len(option_args) == 1 and option_args[0].startswith("--"):
+        option_args = option_args[0].split("=", 1)
+    if not option_args:
+        return arguments
+    if len(option_args) != 2 or option_args[0] not in options or option_args[1].startswith("-"):
+        return None
+    setattr(arguments, options[option_args[0]], option_args[1])
+    return arguments
 
 
 def add_repairs_subcommand(sub_parsers):
@@ -148,33 +210,37 @@ def add_start_subcommand(sub_parsers):
 def add_stop_subcommand(sub_parsers):
     parser_stop = sub_parsers.add_parser("stop",
                                          description="Stop ecChronos service")
-    parser_stop.add_argument("-p", "--pidfile", type=str,
+    # Also parsed by parse_simple_arguments, keep SIMPLE_SUBCOMMAND_OPTIONS in sync when adding options
+    parser_stop.add_argument(*STOP_PIDFILE_OPTIONS, type=str,
                              help="Pidfile where to retrieve the pid, default $ECCHRONOS_HOME/ecc.pid")
 
 
 def add_status_subcommand(sub_parsers):
     parser_status = sub_parsers.add_parser("status",
                                            description="Show status of ecChronos service")
-    parser_status.add_argument("-u", "--url", type=str,
+    # Also parsed by parse_simple_arguments, keep SIMPLE_SUBCOMMAND_OPTIONS in sync when adding options
+    parser_status.add_argument(*STATUS_URL_OPTIONS, type=str,
                                help="The host to connect to with the format (http://<host>:port)",
                                default=None)
 
 
+SUBCOMMAND_PARSERS = {
+    "repairs": add_repairs_subcommand,
+    "schedules": add_schedules_subcommand,
+    "run-repair": add_run_repair_subcommand,
+    "repair-info": add_repair_info_subcommand,
+    "start": add_start_subcommand,
+    "stop": add_stop_subcommand,
+    "status": add_status_subcommand,
+}
+
+
 def schedules(arguments):
-    # pylint: disable=too-many-branches
+    rest, table_printer = _load_rest()
     request = rest.V2RepairSchedulerRequest(base_url=arguments.url)
-    full = False
     if arguments.id:
-        if arguments.full:
-            result = request.get_schedule(job_id=arguments.id, full=True)
-            full = True
-        else:
-            result = request.get_schedule(job_id=arguments.id)
-
-        if result.is_successful():
-            table_printer.print_schedule(result.data, arguments.limit, full)
-        else:
-            print(result.format_exception())
+        result = request.get_schedule(job_id=arguments.id, full=arguments.full)
+        print_result(result, table_printer.print_schedule, arguments.limit, arguments.full)
     elif arguments.full:
         print("Must specify id with full")
         sys.exit(1)
@@ -183,56 +249,39 @@ def schedules(arguments):
             print("Must specify keyspace")
             sys.exit(1)
         result = request.list_schedules(keyspace=arguments.keyspace, table=arguments.table)
-        if result.is_successful():
-            table_printer.print_schedules(result.data, arguments.limit)
-        else:
-            print(result.format_exception())
+        print_result(result, table_printer.print_schedules, arguments.limit)
     else:
         result = request.list_schedules(keyspace=arguments.keyspace)
-        if result.is_successful():
-            table_printer.print_schedules(result.data, arguments.limit)
-        else:
-            print(result.format_exception())
+        print_result(result, table_printer.print_schedules, arguments.limit)
 
 
 def repairs(arguments):
+    rest, table_printer = _load_rest()
     request = rest.V2RepairSchedulerRequest(base_url=arguments.url)
     if arguments.id:
         result = request.get_repair(job_id=arguments.id, host_id=arguments.hostid)
-        if result.is_successful():
-            table_printer.print_repairs(result.data, arguments.limit)
-        else:
-            print(result.format_exception())
     elif arguments.table:
         if not arguments.keyspace:
             print("Must specify keyspace")
             sys.exit(1)
         result = request.list_repairs(keyspace=arguments.keyspace, table=arguments.table, host_id=arguments.hostid)
-        if result.is_successful():
-            table_printer.print_repairs(result.data, arguments.limit)
-        else:
-            print(result.format_exception())
     else:
         result = request.list_repairs(keyspace=arguments.keyspace, host_id=arguments.hostid)
-        if result.is_successful():
-            table_printer.print_repairs(result.data, arguments.limit)
-        else:
-            print(result.format_exception())
+    print_result(result, table_printer.print_repairs, arguments.limit)
 
 
 def run_repair(arguments):
+    rest, table_printer = _load_rest()
     request = rest.V2RepairSchedulerRequest(base_url=arguments.url)
     if not arguments.keyspace and arguments.table:
         print("--keyspace must be specified if table is specified")
         sys.exit(1)
     result = request.post(keyspace=arguments.keyspace, table=arguments.table, local=arguments.local)
-    if result.is_successful():
-        table_printer.print_repairs(result.data)
-    else:
-        print(result.format_exception())
+    print_result(result, table_printer.print_repairs)
 
 
 def repair_info(arguments):
+    rest, table_printer = _load_rest()
     request = rest.V2RepairSchedulerRequest(base_url=arguments.url)
     if not arguments.keyspace and arguments.table:
         print("--keyspace must be specified if table is specified")
@@ -245,107 +294,232 @@ def repair_info(arguments):
         if arguments.duration[0] == "+" or arguments.duration[0] == "-":
             print("'+' and '-' is not allowed in duration, check help for more information")
             sys.exit(1)
-        duration = arguments.duration.upper()
+        duration = parse_duration(arguments.duration)
+        if duration is None:
+            print(f"Invalid duration '{arguments.duration}', check help for more information")
+            sys.exit(1)
     result = request.get_repair_info(keyspace=arguments.keyspace, table=arguments.table,
                                      since=arguments.since, duration=duration,
                                      local=arguments.local)
+    print_result(result, table_printer.print_repair_info, arguments.limit)
+
+
+def parse_duration(duration):
+    # Returns the duration upper cased if it is in the simple or ISO8601 format, otherwise None.
+    # The format is validated case-insensitively so that malformed input is rejected before upper casing it.
+    if duration[:1] in ("P", "p"):
+        valid = _is_iso_duration(duration, 1)
+    else:
+        end = _digits_end(duration, 0)
+        valid = end > 0 and duration[end:].upper() in SIMPLE_DURATION_UNITS
+    return duration.upper() if valid else None
+
+
+def _is_iso_duration(duration, index):
+    components = 0
+    end = _digits_end(duration, index)
+    if index < end < len(duration) and duration[end] in ("D", "d"):
+        index = end + 1
+        components += 1
+    if index < len(duration) and duration[index] in ("T", "t"):
+        index += 1
+        time_components = 0
+        for unit in ("Hh", "Mm", "Ss"):
+            end = _digits_end(duration, index)
+            if unit == "Ss" and index < end < len(duration) and duration[end] in ".,":
+                fraction_end = _digits_end(duration, end + 1)
+                # Same limit as java.time.Duration.parse, which the server uses
+                if fraction_end - (end + 1) > MAX_DURATION_FRACTION_DIGITS:
+                    return False
+                end = fraction_end
+            if index < end < len(duration) and duration[end] in unit:
+                index = end + 1
+                time_components += 1
+        if time_components == 0:
+            return False
+        components += time_components
+    return components > 0 and index == len(duration)
+
+
+def _digits_end(value, index):
+    while index < len(value) and "0" <= value[index] <= "9":
+        index += 1
+    return index
+
+
+def print_result(result, printer, *args):
     if result.is_successful():
-        table_printer.print_repair_info(result.data, arguments.limit)
+        printer(result.data, *args)
     else:
-        print(result.format_exception())
+        print_failure(result)
+
+
+def print_failure(result):
+    # Failing to connect at all means that ecChronos is not running
+    if result.is_connection_error():
+        print("ecChronos is not running")
+        sys.exit(1)
+    print(result.format_exception())
 
 
 def start(arguments):
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    ecchronos_home_dir = os.path.join(script_dir, "..")
-    conf_dir = os.path.join(ecchronos_home_dir, "conf")
-    class_path = get_class_path(conf_dir, ecchronos_home_dir)
-    jvm_opts = get_jvm_opts(conf_dir)
-    command = "java {0} -cp {1} {2}".format(jvm_opts, class_path, SPRINGBOOT_MAIN_CLASS)
-    run_ecc(ecchronos_home_dir, command, arguments)
+    run_ecc(ECCHRONOS_HOME_DIR, get_command(), arguments)
+
+
+def get_command():
+    conf_dir = os.path.join(ECCHRONOS_HOME_DIR, "conf")
+    cache_file = os.path.join(ECCHRONOS_HOME_DIR, COMMAND_CACHE_FILE)
+    command = read_command_cache(cache_file, conf_dir)
+    if command is None:
+        class_path = get_class_path(conf_dir, ECCHRONOS_HOME_DIR)
+        jvm_opts = get_jvm_opts(conf_dir)
+        command = ["java"] + jvm_opts + ["-cp", class_path, SPRINGBOOT_MAIN_CLASS]
+        try:
+            write_file_atomically(cache_file, "\n".join([ECCHRONOS_HOME_DIR] + command).encode("utf-8"))
+        except OSError:
+            pass # The cache is optional, e.g. ecChronos home could be read-only
+    return command
+
+
+def read_command_cache(cache_file, conf_dir):
+    # The cached command is valid until ecctool, jvm.options or the contents of lib/ change,
+    # ctime is used as it also changes when files are replaced with an older mtime, e.g. by tar
+    try:
+        cache_mtime = os.stat(cache_file).st_mtime_ns
+        changed_at = max(os.stat(__file__).st_ctime_ns,
+                         os.stat(os.path.join(conf_dir, "jvm.options")).st_ctime_ns,
+                         os.stat(os.path.join(ECCHRONOS_HOME_DIR, "lib")).st_ctime_ns)
+        if cache_mtime <= changed_at:
+            return None
+        with open(cache_file, "rb") as c_file:
+            lines = c_file.read().decode("utf-8").split("\n")
+    except (OSError, ValueError):
+        # A missing or corrupt cache is treated as a cache miss
+        return None
+    # The command contains absolute paths, so it can't be reused if ecChronos home has moved
+    if lines[0] != ECCHRONOS_HOME_DIR:
+        return None
+    return lines[1:]
 
 
 def get_class_path(conf_dir, ecchronos_home_dir):
-    class_path = conf_dir
-    jar_glob = os.path.join(ecchronos_home_dir, "lib", "*.jar")
-    for jar_file in glob.glob(jar_glob):
-        class_path += ":{0}".format(jar_file)
-    return class_path
+    with os.scandir(os.path.join(ecchronos_home_dir, "lib")) as entries:
+        jar_files = [entry.path for entry in entries if entry.name.endswith(".jar")]
+    return ":".join([conf_dir] + jar_files)
 
 
 def get_jvm_opts(conf_dir):
-    jvm_opts = ""
     with open(os.path.join(conf_dir, "jvm.options"), "r", encoding="utf-8") as options_file:
-        for line in options_file.readlines():
-            if line.startswith("-"):
-                jvm_opts += "{0} ".format(line)
-    return jvm_opts + "-Decchronos.config={0}".format(conf_dir)
+        jvm_opts = [line.rstrip() for line in options_file if line.startswith("-")]
+    jvm_opts.append(f"-Decchronos.config={conf_dir}")
+    return jvm_opts
 
 
 def run_ecc(cwd, command, arguments):
-    if arguments.foreground:
-        command += " -f"
-    proc = subprocess.Popen(command.split(" "), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, # pylint: disable=consider-using-with
-                            cwd=cwd)
-    pid = proc.pid
-    print("ecc started with pid {0}".format(pid))
     pid_file = os.path.join(cwd, DEFAULT_PID_FILE)
     if arguments.pidfile:
-        pid_file = arguments.pidfile
-    with open(pid_file, "w", encoding="utf-8") as p_file:
-        p_file.write(u"{0}".format(pid))
+        pid_file = os.path.abspath(arguments.pidfile)
+    os.chdir(cwd)
     if arguments.foreground:
-        while True:
-            line = proc.stdout.readline()
-            if not line:
-                break
-            sys.stdout.write(line)
-        proc.wait()
+        # Replace this process with java, it keeps the pid written to the pid file
+        pid = os.getpid()
+        print(f"ecc started with pid {pid}")
+        write_pid_file(pid_file, pid)
+        sys.stdout.flush()
+        for signum in RESTORED_SIGNALS:
+            signal.signal(signum, signal.SIG_DFL)
+        os.execvp(command[0], command + ["-f"])
+    pid = spawn_detached(command)
+    print(f"ecc started with pid {pid}")
+    write_pid_file(pid_file, pid)
+
+
+def spawn_detached(command):
+    # Detach java from our stdio, nothing is left to read its output once we exit
+    if not hasattr(os, "posix_spawnp"):
+        # posix_spawnp is only available from Python 3.8
+        return subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, # pylint: disable=consider-using-with
+                                stderr=subprocess.STDOUT).pid
+    file_actions = [(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                    (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+                    (os.POSIX_SPAWN_DUP2, 1, 2)]
+    # Python ignores these signals, like Popen we restore their defaults for java
+    return os.posix_spawnp(command[0], command, os.environ, file_actions=file_actions,
+                           setsigdef=RESTORED_SIGNALS)
+
+
+def write_pid_file(pid_file, pid):
+    write_file_atomically(pid_file, b"%d" % pid)
+
+
+def write_file_atomically(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_path, path)
 
 
 def stop(arguments):
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    ecchronos_home_dir = os.path.join(script_dir, "..")
-    pid_file = os.path.join(ecchronos_home_dir, DEFAULT_PID_FILE)
+    pid_file = os.path.join(ECCHRONOS_HOME_DIR, DEFAULT_PID_FILE)
     if arguments.pidfile:
         pid_file = arguments.pidfile
-    with open(pid_file, "r", encoding="utf-8") as p_file:
-        pid = int(p_file.readline())
-        print("Killing ecc with pid {0}".format(pid))
+    with open(pid_file, "rb") as p_file:
+        pid = int(p_file.read().strip())
+    print(f"Killing ecc with pid {pid}")
+    try:
         os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        print(f"ecc with pid {pid} is not running")
+    else:
+        if not wait_for_exit(pid, STOP_TIMEOUT_SECONDS):
+            print(f"ecc with pid {pid} did not stop within {STOP_TIMEOUT_SECONDS} seconds")
+            sys.exit(1)
     os.remove(pid_file)
 
 
-def status(arguments, print_running=False):
+def wait_for_exit(pid, timeout):
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1)
+
+
+def status(arguments):
+    rest, _ = _load_rest()
     request = rest.V2RepairSchedulerRequest(base_url=arguments.url)
     result = request.list_schedules()
     if result.is_successful():
-        if print_running:
-            print("ecChronos is running")
+        print("ecChronos is running")
     else:
         print("ecChronos is not running")
         sys.exit(1)
 
 
+SUBCOMMANDS = {
+    "repairs": repairs,
+    "schedules": schedules,
+    "run-repair": run_repair,
+    "repair-info": repair_info,
+    "start": start,
+    "stop": stop,
+    "status": status,
+}
+
+
 def run_subcommand(arguments):
-    if arguments.subcommand == "repairs":
-        status(arguments)
-        repairs(arguments)
-    elif arguments.subcommand == "schedules":
-        status(arguments)
-        schedules(arguments)
-    elif arguments.subcommand == "run-repair":
-        status(arguments)
-        run_repair(arguments)
-    elif arguments.subcommand == "repair-info":
-        status(arguments)
-        repair_info(arguments)
-    elif arguments.subcommand == "start":
-        start(arguments)
-    elif arguments.subcommand == "stop":
-        stop(arguments)
-    elif arguments.subcommand == "status":
-        status(arguments, print_running=True)
+    subcommand = SUBCOMMANDS.get(arguments.subcommand)
+    if subcommand:
+        subcommand(arguments)
 
 
 def main():
@@ -48,6 +48,9 @@ class RequestResult(object):
     def is_successful(self):
         return self.status_code == 200
 
+    def is_connection_error(self):
+        return isinstance(self.exception, URLError) and not isinstance(self.exception, HTTPError)
+
     def transform_with_data(self, new_data):
         return RequestResult(status_code=self.status_code,
                              data=new_data,
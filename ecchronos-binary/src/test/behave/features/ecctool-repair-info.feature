@@ -69,6 +69,11 @@ Feature: ecctool repair-info
     And the output should contain a repair-info row for test2.table2
     And the output should not contain more rows
 
+  Scenario: Get repair-info with invalid duration
+    Given we have access to ecctool
+    When we get repair-info with duration 3x
+    Then the repair-info should fail with invalid duration 3x
+
   Scenario: Get repair-info for all tables with since and duration
     Given we have access to ecctool
     When we get repair-info with since 0 and duration 0
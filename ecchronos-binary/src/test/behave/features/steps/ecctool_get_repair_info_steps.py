@@ -120,3 +120,10 @@ def step_validate_repair_info_header(context):
 def step_validate_repair_info_row(context, keyspace, table):
     expected_row = table_row(keyspace, table)
     match_and_remove_row(context.rows, expected_row)
+
+
+@then(u'the repair-info should fail with invalid duration {duration}')
+def step_validate_repair_info_invalid_duration(context, duration):
+    assert context.proc.returncode == 1, context.proc.returncode
+    expected_output = "Invalid duration '{0}', check help for more information".format(duration)
+    assert context.out.decode('ascii').strip() == expected_output, context.out